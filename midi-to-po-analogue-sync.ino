@@ -108,8 +108,8 @@
 #define IGNORE_STOP 0  // use RST to stop manually and arm for next auto-start
 #define IGNORE_RESET 1  // use RST to force it all off
 #define IGNORE_PARSE_ERROR 1  // if MIDI.h fails to parse a byte, used for debug
-#define PULSE_CHECK_PERIOD 5  // only poll if pulses should be off this often
-unsigned long PULSE_CHECK_MILLIS = 0;
+#define MIDI_READ_MAX 8  // max reads per loop, drains a backlog without starving the pulse checks
+#define MIDI_BUSY_SKIP_MAX 4  // max loops in a row that skip the pulse checks to keep reading a backlog
 /* PO/Volca/Analogue Sync V-trig pulse
  * Prev volca-po-analogue-sync-divider req minimum of 30 msec pulse and refactory period
  *   - 15 in the active state, 14 low/sleep, and loop had a 1 sleep (so loop could use lower power, only poll 1/msec)
@@ -121,7 +121,21 @@ unsigned long PULSE_CHECK_MILLIS = 0;
  */
 #define OUT_D_PO_SYNC 1  // on board LED is on pin 1
 #define SYNC_PULSE_PERIOD 15
-unsigned long SYNC_PULSE_ON_MILLIS = 0;
+/* The v-trig is timed in hardware, not polled with millis()
+ * Pin 1 is PB1, which is also OC1A (Timer1 compare output A) on the t85
+ *   - sync_pin_on forces OC1A high and restarts Timer1, then Timer1 clears OC1A itself on the compare match
+ *   - so the falling edge happens SYNC_PULSE_PERIOD later no matter how busy loop/SoftwareSerial are, and there is no ISR
+ * Timer0 is millis(), Timer1 is only otherwise used by analogWrite on pin 4 (OUT_A_CV, not implemented)
+ * CK/1024 so 15 msecs fits in the 8 bit counter at both 8 MHz (117 ticks) and 16 MHz (234 ticks)
+ */
+#define SYNC_TIMER_PRESCALE (_BV(CS13) | _BV(CS11) | _BV(CS10))  // CK/1024
+#define SYNC_PULSE_TICKS ((SYNC_PULSE_PERIOD * (F_CPU / 1000UL)) / 1024UL)
+#if OUT_D_PO_SYNC != 1
+#error "OUT_D_PO_SYNC must be pin 1 (OC1A) for the Timer1 v-trig"
+#endif
+#if SYNC_PULSE_TICKS > 255
+#error "SYNC_PULSE_PERIOD is too long for Timer1 at CK/1024"
+#endif
 /* Input
  * Using Pin 2, which is dread 2, but aread 1
  * Possible inputs:
@@ -142,6 +156,11 @@ unsigned long SYNC_PULSE_ON_MILLIS = 0;
 #define OUT_D_LB_SYNC 3  // shared with USB, has 1.5k pullup on it per board spec
 #define LB_STRIG_PERIOD 15
 unsigned long LB_STRING_MILLIS = 0;
+// write PORTB directly instead of digitalWrite (progmem port/bit lookups, cli/sei), pin 3 is PB3
+// a constant port and bit compile to a single atomic sbi/cbi
+#if OUT_D_LB_SYNC != 3
+#error "OUT_D_LB_SYNC must be pin 3 (PB3) for the direct PORTB writes"
+#endif
 // CV output
 //  Default CV is gated (by key press) glissando (ignore note on retriggers) (no clock retrigger), latest note, up-down arp
 #define OUT_A_CV 4  // if not CV then OUT_D_GATE
@@ -156,6 +175,9 @@ unsigned long LB_STRING_MILLIS = 0;
     SoftwareSerial midiSerial(IN_D_MIDI, IN_D_MIDI); // Rx, Tx
     // in SoftwareSerial.cpp constructor, setRX happens after setTX, so Rx overrides Tx, and Rx == Tx is ok
     // see https://github.com/PaulStoffregen/SoftwareSerial/blob/63f9b1aae6564d301d7ba31261d1f2390e2a7359/SoftwareSerial.cpp#L578
+    // Rx buffer is _SS_MAX_RX_BUFF (64 bytes), about 20 msecs of MIDI at 31250 baud
+    // it's sized in SoftwareSerial.h and compiled into the library, defining it here would not change it (and 512 B SRAM can't spare more)
+    // so the buffer is kept near empty instead, see MIDI_READ_MAX and MIDI_BUSY_SKIP_MAX in loop
     MIDI_CREATE_INSTANCE(SoftwareSerial, midiSerial, midiPoLb);
 #endif
 
@@ -163,20 +185,34 @@ unsigned long LB_STRING_MILLIS = 0;
 void handleClock();
 void handleStart();
 void handleContinue();
+#if !IGNORE_STOP
 void handleStop();
+#endif
+#if !IGNORE_RESET
 void handleSystemReset();
+#endif
+#if !IGNORE_PARSE_ERROR
 void handleError();
-void pulse_beat();
-void pulse_half_beat();
-void start_lb();
-void stop_lb();
-void lb_pin_low();
-void lb_pin_high(unsigned long now=0);
-void sync_pin_on();
-void sync_pin_off(unsigned long now=0);
-
-
-unsigned int clock_ticks = 0;
+#endif
+// helpers are only called from this sketch, static lets the compiler inline them into the handlers/loop
+// and drop the standalone copies, even when the core is built without -flto
+static void pulse_beat();
+static void pulse_half_beat();
+static void start_lb();
+static void stop_lb();
+static void lb_pin_low();
+static void lb_pin_high(unsigned long now=0);
+static void sync_pin_on();
+static void sync_pin_off();
+
+
+// Beat tracking, assume 4/4 so a beat is a quarter note
+#define CLOCKS_PER_BEAT 24  // MIDI clock is 24 PPQN
+#define CLOCKS_PER_HALF_BEAT 12  // PO/Volca are 2 PPQN, so 1 sync pulse per 12 MIDI clocks
+// clocks remaining until the next half beat/beat pulse, 1 so the 1st clock after a start pulses
+// byte, not int, the ATtiny is 8 bit and these never exceed CLOCKS_PER_BEAT
+byte half_beat_left = 1;
+byte beat_left = 1;
 bool pulsing = false;
 
 
@@ -193,11 +229,14 @@ void setup() {
   // default Arduino named function called once, before loop
   // NOTE 16 MHz reqs 5v (not good if using MIDI Vref)
   if (F_CPU == 16000000) clock_prescale_set(clock_div_1);
-  clock_ticks = 0;
+  half_beat_left = 1;
+  beat_left = 1;
   pulsing = false;
   pinMode(OUT_D_PO_SYNC, OUTPUT);
   digitalWrite(OUT_D_PO_SYNC, LOW);
-  SYNC_PULSE_ON_MILLIS = 0;
+  // hand pin 1 to Timer1 OC1A, normal (non PWM) mode, clear OC1A on compare match
+  OCR1A = SYNC_PULSE_TICKS;
+  sync_pin_off();
   pinMode(OUT_D_LB_SYNC, OUTPUT);
   digitalWrite(OUT_D_LB_SYNC, LOW);
   LB_STRING_MILLIS = 0;
@@ -205,11 +244,22 @@ void setup() {
   midiPoLb.setHandleClock(handleClock);
   midiPoLb.setHandleStart(handleStart);
   midiPoLb.setHandleContinue(handleContinue);
-  if (!IGNORE_STOP) midiPoLb.setHandleStop(handleStop);
-  if (!IGNORE_RESET) midiPoLb.setHandleSystemReset(handleSystemReset);
-  if (!IGNORE_PARSE_ERROR) midiPoLb.setHandleError(handleError);
+  // preprocessor, not if, so ignored handlers (and handleError's debug delay/blink) are not compiled in at all
+#if !IGNORE_STOP
+  midiPoLb.setHandleStop(handleStop);
+#endif
+#if !IGNORE_RESET
+  midiPoLb.setHandleSystemReset(handleSystemReset);
+#endif
+#if !IGNORE_PARSE_ERROR
+  midiPoLb.setHandleError(handleError);
+#endif
   // begin(int inChannel=1)
   midiPoLb.begin();
+  // begin turns on Thru, which echoes every parsed message (incl each clock) back out the Tx pin
+  // Tx is the same pin as Rx, and a SoftwareSerial write disables interrupts for the whole byte, dropping Rx bits
+  // so only dispatch to the setHandle* callbacks above
+  midiPoLb.turnThruOff();
 }
 
 
@@ -218,28 +268,46 @@ void loop() {
   /* read(int inChannel=midiPoLb.inChannel) aka can be given chan to read, else defaults to one from begin
    * blocks as long as it takes to handle any messages
    * reads MIDI clock/sync messages and uses callbacks (setHandle*) to:
-   *   - advance clock_ticks, which leads to calling pulse_*
+   *   - count down half_beat_left/beat_left, which leads to calling pulse_*
    *   - respond to start/continue to turn on pulsing
    *   - respond to stop/reset to turn off pulsing (unless IGNORE_STOP/IGNORE_RESET)
    *   Do not use delay() in combo with softwareserial read
+   * MIDI.h parses at most one byte per read, so keep reading while bytes are buffered
+   * otherwise a backlog (ex: a note between two clocks) makes later clocks wait extra loops
+   */
+  for (byte i = 0; i < MIDI_READ_MAX; i++) {
+    midiPoLb.read();
+    if (!midiSerial.available()) break;
+  }
+  /* SoftwareSerial already fills its Rx buffer from the pin change interrupt, in the background of loop
+   * so parsing only falls behind when loop is busy elsewhere
+   * If bytes are still waiting after MIDI_READ_MAX reads, go straight back to reading them
+   * but only for MIDI_BUSY_SKIP_MAX loops in a row, a long backlog (sysex, dense notes/CC) must not hold the strig low
    */
-  midiPoLb.read();
+  static byte busy_loops = 0;
+  if (midiSerial.available() && busy_loops < MIDI_BUSY_SKIP_MAX) {
+    busy_loops++;
+    return;
+  }
+  busy_loops = 0;
   /* millis() are interrupt driven, which competes with software serial
    * Reduce millis calls to prioritize midi.read/reduce its errors:
    *   - Only call once here and pass value
-   *   - Reduce non-midi.read calls, by only doing them if its been x msecs
+   *   - Only call when a pulse is actually on, otherwise there is nothing to undo
+   * This used to be gated to every 5 msecs, but that let a 15 msec pulse run up to 20 msecs
+   * The vtrig is ended by Timer1, so only the strig needs polling
    */
-  unsigned long now = millis();
-  if ((now - PULSE_CHECK_MILLIS) > PULSE_CHECK_PERIOD) {
-    sync_pin_off(now);  // undo vtrig if it's been enough time
-    lb_pin_high(now);  // undo strig if it's been enough time
-    PULSE_CHECK_MILLIS = now;
+  if (!LB_STRING_MILLIS) {
+    return;
   }
+  lb_pin_high(millis());  // undo strig if it's been enough time
 }
 
 
 /* Helper functions
  * Turning on and off pins, setting timers, global bools/flags, etc
+ * Pins are only written on a change of state (pulse on, or the poll seeing LB_STRING_MILLIS expire), never every loop
+ * so there is no last-written-value cache, comparing against one would cost more than the 2 cycle sbi/cbi LB write
  */
 void pulse_beat() {
   // called once per 24 MIDI clocks (once per beat)
@@ -256,14 +324,14 @@ void pulse_half_beat() {
 
 
 void start_lb() {
-  digitalWrite(OUT_D_LB_SYNC, HIGH);
+  PORTB |= _BV(PB3);  // HIGH
   LB_STRING_MILLIS = 0;
   // notes/cv
 }
 
 
 void stop_lb() {
-  digitalWrite(OUT_D_LB_SYNC, LOW);
+  PORTB &= ~_BV(PB3);  // LOW
   LB_STRING_MILLIS = 0;
   // notes/cv
 }
@@ -271,7 +339,7 @@ void stop_lb() {
 
 void lb_pin_low() {
   // send a strig on the LB Sync out pin
-  digitalWrite(OUT_D_LB_SYNC, LOW);
+  PORTB &= ~_BV(PB3);  // LOW
   LB_STRING_MILLIS = millis();
 }
 
@@ -284,7 +352,7 @@ void lb_pin_high(unsigned long now=0) {
     }
     // attiny millis overflow is ~49 days, logic to detect that condition out of scope for this sketch
     if ((now - LB_STRING_MILLIS) > LB_STRIG_PERIOD) {
-      digitalWrite(OUT_D_LB_SYNC, HIGH);
+      PORTB |= _BV(PB3);  // HIGH
       LB_STRING_MILLIS = 0;
     }
   }
@@ -293,30 +361,28 @@ void lb_pin_high(unsigned long now=0) {
 
 void sync_pin_on() {
   // send a pulse on the PO/Volca/Analogue Sync out pin
-  digitalWrite(OUT_D_PO_SYNC, HIGH);
-  SYNC_PULSE_ON_MILLIS = millis();
+  // restart the count first, so the compare match is a full SYNC_PULSE_TICKS away
+  TCNT1 = 0;
+  GTCCR |= _BV(PSR1);  // reset the prescaler too
+  // force OC1A high now, then let the compare match clear it
+  TCCR1 = _BV(COM1A1) | _BV(COM1A0) | SYNC_TIMER_PRESCALE;  // set OC1A on match
+  GTCCR |= _BV(FOC1A);  // HIGH
+  TCCR1 = _BV(COM1A1) | SYNC_TIMER_PRESCALE;  // clear OC1A on match
 }
 
 
-void sync_pin_off(unsigned long now=0) {
-  // polled each loop, if the pulse has been high long enough, turn it off
-  if (SYNC_PULSE_ON_MILLIS) {
-    if (!now) {
-      now = millis();
-    }
-    // attiny millis overflow is ~49 days, logic to detect that condition out of scope for this sketch
-    if ((now - SYNC_PULSE_ON_MILLIS) > SYNC_PULSE_PERIOD) {
-      digitalWrite(OUT_D_PO_SYNC, LOW);
-      SYNC_PULSE_ON_MILLIS = 0;
-    }
-  }
+void sync_pin_off() {
+  // end any pulse now, instead of waiting for the compare match
+  // the counter free runs and matches again every 256 ticks, which just re-clears a low pin
+  TCCR1 = _BV(COM1A1) | SYNC_TIMER_PRESCALE;  // clear OC1A on match
+  GTCCR |= _BV(FOC1A);  // LOW
 }
 
 
 /* MIDI Handlers
  * Do any of these need to be covered?
- *   - TimeCodeQuarterFrame (if 0, stop and start/set clock_ticks to 0)?
- *   - SongPosition (if 0, stop and start, set clock_ticks to 0)?
+ *   - TimeCodeQuarterFrame (if 0, stop and start/reset the beat countdowns)?
+ *   - SongPosition (if 0, stop and start, reset the beat countdowns)?
  *   - SongSelect (stop and start)?
  */
 void handleClock() {
@@ -324,34 +390,41 @@ void handleClock() {
   if (!pulsing) {
     return;
   }
+  // work on local copies, the pulse_* calls force a global to be reloaded/stored around each call
+  // count down to the next pulse rather than % a tick counter, AVR has no divide instruction
+  byte half = half_beat_left - 1;
+  byte beat = beat_left - 1;
   // Assume 4/4 time, so a beat is a quarter note
   // There are 24 MIDI clocks per beat, so 24 MIDI PPQN
   // PO and Volca use 2 PPQN, so 12 MIDI pulses per 1 PO pulse
-  if ((clock_ticks % 12) == 0) {
-    //                   0         1         2
-    // clock_ticks (in)  0123456789012345678901234
-    // call pulse?       ynnnnnnnnnnnynnnnnnnnnnny
-    // clock_ticks (out) 1234567890123456789012341
+  if (half == 0) {
+    //                     0         1         2
+    // clock # since start 0123456789012345678901234
+    // half_beat_left (in) 1cba987654321cba987654321  (hex)
+    // call pulse?         ynnnnnnnnnnnynnnnnnnnnnny
+    half = CLOCKS_PER_HALF_BEAT;
     pulse_half_beat();
   }
   // http://lauterzeit.com/arp_lfo_seq_sync/
-  if ((clock_ticks % 24) == 0) {
-    // avoid eventual overflow
-    clock_ticks = 0;
-    //                   0         1         2
-    // clock_ticks (in)  0123456789012345678901234
-    // call pulse?       ynnnnnnnnnnnnnnnnnnnnnnny
-    // clock_ticks (out) 1234567890123456789012341
+  if (beat == 0) {
+    //                     0         1         2
+    // clock # since start 0123456789012345678901234
+    // beat_left (in)      1 then 24 down to 1
+    // call pulse?         ynnnnnnnnnnnnnnnnnnnnnnny
+    beat = CLOCKS_PER_BEAT;
+    // the vtrig is on Timer1, so the strig's millis() is the only clock read on this path
     pulse_beat();
   }
-  clock_ticks++;
+  half_beat_left = half;
+  beat_left = beat;
 }
 
 
 void handleStart() {
   // 0xfa It's uncertain if there should be a pulse on start, or only the 1st clock after a start
   // this logic assumes the 1st pulse is the 1st clock after a start
-  clock_ticks = 0;  // if pulsing and fake start comes in, you may get off beat
+  half_beat_left = 1;  // if pulsing and fake start comes in, you may get off beat
+  beat_left = 1;
   pulsing = true;
   start_lb();
 }
@@ -367,6 +440,7 @@ void handleContinue() {
 }
 
 
+#if !IGNORE_STOP
 void handleStop() {
   // 0xfe clock is going, but ignore it until started again
   // allow manual/gated key presses through
@@ -374,25 +448,28 @@ void handleStop() {
   pulsing = false;
   stop_lb();
 }
+#endif
 
 
+#if !IGNORE_RESET
 void handleSystemReset() {
   // 0xff system panic, turn off any outputs
   // TODO turn off any cv/notes
   pulsing = false;
-  digitalWrite(OUT_D_PO_SYNC, LOW);
-  SYNC_PULSE_ON_MILLIS = 0;
-  digitalWrite(OUT_D_LB_SYNC, LOW);
-  LB_STRING_MILLIS = 0;
+  sync_pin_off();
+  stop_lb();
 }
+#endif
 
 
+#if !IGNORE_PARSE_ERROR
 void handleError() {
   // If MIDI.h can't parse the serial input, it'll call this
   // temporary debug, just visually show that it happened
   pulsing = false;
   stop_lb();
-  SYNC_PULSE_ON_MILLIS = 0;
+  sync_pin_off();
+  TCCR1 = SYNC_TIMER_PRESCALE;  // disconnect OC1A so digitalWrite drives pin 1, the next sync_pin_on reconnects it
   digitalWrite(OUT_D_PO_SYNC, LOW);
   delay(100);
   digitalWrite(OUT_D_PO_SYNC, HIGH);
@@ -401,3 +478,4 @@ void handleError() {
   delay(100);
   digitalWrite(OUT_D_PO_SYNC, HIGH);
 }
+#endif